@@ -21,16 +21,22 @@ an interactive bash shell.
 """
 
 import argparse
-import collections
+import atexit
+import functools
 import os
 import re
+import shlex
 import subprocess
+import sys
+import tempfile
 from .overlay import BindMount
 from .overlay import BindOverlay
 
 _DEFAULT_META_ANDROID_DIR = 'LINUX/android'
 _DEFAULT_COMMAND = '/bin/bash'
 
+_ADB_FORKSERVER_RE = re.compile(r'adb.*fork-server')
+
 _SOURCE_MOUNT_POINT = '/src'
 _OUT_MOUNT_POINT = '/src/out'
 _DIST_MOUNT_POINT = '/dist'
@@ -38,12 +44,82 @@ _META_MOUNT_POINT = '/meta'
 
 _CHROOT_MOUNT_POINTS = [
   'bin', 'sbin',
-  'etc/alternatives', 'etc/default' 'etc/perl',
+  'etc/alternatives', 'etc/default', 'etc/perl',
   'etc/ssl', 'etc/xml',
   'lib', 'lib32', 'lib64', 'libx32',
   'usr',
 ]
 
+# Precomputed (relative path, parent directory, entry name, destination)
+# tuples so run() does not re-split and re-join the paths on every call.
+_CHROOT_MOUNT_POINTS_JOINED = tuple(
+    (m, os.path.dirname(m), os.path.basename(m), '/' + m)
+    for m in _CHROOT_MOUNT_POINTS)
+
+# Conservative bound kept well below common ARG_MAX limits; commands longer
+# than this carry their bind mounts in a generated config file instead.
+_MAX_COMMAND_LENGTH = 128 * 1024
+
+def _dump_mounts_to_config(nsjail_command, config_file):
+  """Moves the bind mount arguments into a generated nsjail config file.
+
+  Large overlay configurations can push the nsjail command past the
+  operating system argument size limit. Rewrite the command so the bind
+  mounts are carried as mount stanzas in a temporary config file that
+  extends the base config, leaving only a handful of argv entries.
+
+  Args:
+    nsjail_command: A list of strings with the assembled nsjail command.
+    config_file: A string path to the base nsjail configuration file.
+
+  Returns:
+    The rewritten command list.
+  """
+  try:
+    separator = nsjail_command.index('--')
+  except ValueError:
+    separator = len(nsjail_command)
+
+  new_command = []
+  mounts = []
+  index = 0
+  while index < len(nsjail_command):
+    arg = nsjail_command[index]
+    if index < separator and arg in ('--bindmount', '--bindmount_ro'):
+      source, _, dest = nsjail_command[index + 1].partition(':')
+      mounts.append((source, dest or source, arg == '--bindmount'))
+      index += 2
+      continue
+    new_command.append(arg)
+    index += 1
+
+  with open(config_file) as f:
+    base_config = f.read()
+
+  with tempfile.NamedTemporaryFile(
+      'w', prefix='nsjail-mounts-', suffix='.cfg', delete=False) as tmp:
+    tmp.write(base_config)
+    for source, dest, read_write in mounts:
+      tmp.write('\nmount {\n'
+                f'  src: "{source}"\n'
+                f'  dst: "{dest}"\n'
+                '  is_bind: true\n'
+                f'  rw: {"true" if read_write else "false"}\n'
+                '}\n')
+    generated_config = tmp.name
+  atexit.register(os.unlink, generated_config)
+
+  new_command[new_command.index('--config') + 1] = generated_config
+  return new_command
+
+
+@functools.lru_cache(maxsize=8)
+def _meta_paths(meta_android_dir):
+  """Returns the jail mount points for the META Android dir and its out dir."""
+  base = os.path.join(_META_MOUNT_POINT, meta_android_dir)
+  return base, os.path.join(base, 'out')
+
+
 def load_rw_whitelist(rw_whitelist_config):
   """Loads a read/write whitelist configuration file.
 
@@ -98,6 +174,7 @@ def run(command,
         dry_run=False,
         quiet=False,
         env=[],
+        use_exec=False,
         stdout=None,
         stderr=None):
   """Run inside an NsJail sandbox.
@@ -130,6 +207,8 @@ def run(command,
     quiet: If true, the function will not display the command and
       will pass -quiet argument to nsjail
     env: An array of environment variables to define in the jail in the `var=val` syntax.
+    use_exec: If true, replace the current process with nsjail instead of
+      running it as a child process. The function never returns in that case.
     stdout: the standard output for all printed messages. Valid values are None, a file
       descriptor or file object. A None value means sys.stdout is used.
     stderr: the standard error for all printed messages. Valid values are None, a file
@@ -168,6 +247,7 @@ def run(command,
       mount_local_device=mount_local_device,
       dry_run=dry_run,
       quiet=quiet,
+      use_exec=use_exec,
       stdout=stdout,
       stderr=stderr)
 
@@ -227,15 +307,24 @@ def get_command(command,
   script_dir = os.path.dirname(os.path.abspath(__file__))
   config_file = os.path.join(script_dir, 'nsjail.cfg')
 
-  # Run expects absolute paths
+  # Run expects absolute paths. os.path.abspath issues a getcwd(2) syscall
+  # even for paths that are already absolute, so only resolve the current
+  # working directory (at most once) for paths that need it.
+  def _abs(path, _cwd=[None]):
+    if os.path.isabs(path):
+      return path
+    if _cwd[0] is None:
+      _cwd[0] = os.getcwd()
+    return os.path.normpath(os.path.join(_cwd[0], path))
+
   if out_dir:
-    out_dir = os.path.abspath(out_dir)
+    out_dir = _abs(out_dir)
   if dist_dir:
-    dist_dir = os.path.abspath(dist_dir)
+    dist_dir = _abs(dist_dir)
   if meta_root_dir:
-    meta_root_dir = os.path.abspath(meta_root_dir)
+    meta_root_dir = _abs(meta_root_dir)
   if source_dir:
-    source_dir = os.path.abspath(source_dir)
+    source_dir = _abs(source_dir)
 
   if nsjail_bin:
     nsjail_bin = os.path.join(source_dir, nsjail_bin)
@@ -255,18 +344,28 @@ def get_command(command,
   # By mounting the points individually that we need we reduce exposure and
   # keep the chroot clean from artifacts
   if chroot:
-    for mpoints in _CHROOT_MOUNT_POINTS:
-      source = os.path.join(chroot, mpoints)
-      dest = os.path.join('/', mpoints)
-      if os.path.exists(source):
+    # Check which mount points exist with one scandir(2) per directory
+    # instead of one stat(2) per mount point.
+    dir_entries = {}
+    def _dir_names(path):
+      if path not in dir_entries:
+        try:
+          dir_entries[path] = {entry.name for entry in os.scandir(path)}
+        except OSError:
+          dir_entries[path] = set()
+      return dir_entries[path]
+
+    for mpoints, parent, name, dest in _CHROOT_MOUNT_POINTS_JOINED:
+      if name in _dir_names(os.path.join(chroot, parent)):
+        source = os.path.join(chroot, mpoints)
         nsjail_command.extend([
-          '--bindmount_ro', '%s:%s' % (source, dest)
+          '--bindmount_ro', f'{source}:{dest}'
         ])
 
   if build_id:
-    nsjail_command.extend(['--env', 'BUILD_NUMBER=%s' % build_id])
+    nsjail_command.extend(['--env', f'BUILD_NUMBER={build_id}'])
   if max_cpus:
-    nsjail_command.append('--max_cpus=%i' % max_cpus)
+    nsjail_command.append(f'--max_cpus={max_cpus:d}')
   if quiet:
     nsjail_command.append('--quiet')
 
@@ -276,7 +375,7 @@ def get_command(command,
   if out_dir and (
       os.path.dirname(out_dir) == source_dir) and (
       os.path.basename(out_dir) != 'out'):
-    whiteout_list.add(os.path.abspath(out_dir))
+    whiteout_list.add(out_dir)
     if not os.path.exists(out_dir):
       os.makedirs(out_dir)
 
@@ -293,7 +392,7 @@ def get_command(command,
                       rw_whitelist)
     bind_mounts = overlay.GetBindMounts()
   else:
-    bind_mounts = collections.OrderedDict()
+    bind_mounts = {}
     bind_mounts[_SOURCE_MOUNT_POINT] = BindMount(source_dir, False)
 
   if out_dir:
@@ -302,23 +401,39 @@ def get_command(command,
   if dist_dir:
     bind_mounts[_DIST_MOUNT_POINT] = BindMount(dist_dir, False)
     nsjail_command.extend([
-        '--env', 'DIST_DIR=%s'%_DIST_MOUNT_POINT
+        '--env', f'DIST_DIR={_DIST_MOUNT_POINT}'
     ])
 
   if meta_root_dir:
+    meta_android_mount_point, meta_out_mount_point = _meta_paths(meta_android_dir)
     bind_mounts[_META_MOUNT_POINT] = BindMount(meta_root_dir, False)
-    bind_mounts[os.path.join(_META_MOUNT_POINT, meta_android_dir)] = BindMount(source_dir, False)
+    bind_mounts[meta_android_mount_point] = BindMount(source_dir, False)
     if out_dir:
-      bind_mounts[os.path.join(_META_MOUNT_POINT, meta_android_dir, 'out')] = BindMount(out_dir, False)
+      bind_mounts[meta_out_mount_point] = BindMount(out_dir, False)
+
+  # Overlay configs and extra mounts can produce overlapping entries, and
+  # nsjail would perform the same bind mount twice. Track what has been
+  # emitted and skip duplicates.
+  seen_mounts = set()
+
+  def _new_mount(source, dest, readonly):
+    key = (source, dest, readonly)
+    if key in seen_mounts:
+      return False
+    seen_mounts.add(key)
+    return True
 
   for bind_destination, bind_mount in bind_mounts.items():
+    if not _new_mount(bind_mount.source_dir, bind_destination,
+                      bind_mount.readonly):
+      continue
     if bind_mount.readonly:
       nsjail_command.extend([
-        '--bindmount_ro',  bind_mount.source_dir + ':' + bind_destination
+        '--bindmount_ro', f'{bind_mount.source_dir}:{bind_destination}'
       ])
     else:
       nsjail_command.extend([
-        '--bindmount',  bind_mount.source_dir + ':' + bind_destination
+        '--bindmount', f'{bind_mount.source_dir}:{bind_destination}'
       ])
 
   if mount_local_device:
@@ -327,30 +442,43 @@ def get_command(command,
     # a lot of host operating system device space, so it's recommended to use
     # the mount_local_device option only when you need to use adb (e.g., for
     # atest or some other purpose).
-    nsjail_command.extend(['--bindmount', '/dev/bus/usb'])
-    nsjail_command.extend(['--bindmount', '/sys/bus/usb/devices'])
-    nsjail_command.extend(['--bindmount', '/sys/dev'])
-    nsjail_command.extend(['--bindmount', '/sys/devices'])
-
-  for mount in extra_bind_mounts:
-    nsjail_command.extend(['--bindmount', mount])
-  for mount in readonly_bind_mounts:
-    nsjail_command.extend(['--bindmount_ro', mount])
-
-  for var in env:
-    nsjail_command.extend(['--env', var])
+    for mount in ('/dev/bus/usb', '/sys/bus/usb/devices', '/sys/dev',
+                  '/sys/devices'):
+      if _new_mount(mount, mount, False):
+        nsjail_command.extend(['--bindmount', mount])
+
+  def _dedup_mounts(mounts, readonly):
+    for mount in mounts:
+      source, _, dest = mount.partition(':')
+      if _new_mount(source, dest or source, readonly):
+        yield mount
+
+  # Emit the remaining flag/value pairs with a single extend so the list is
+  # resized once for the whole batch instead of once per entry.
+  nsjail_command.extend(
+      arg
+      for flag, values in (
+          ('--bindmount', _dedup_mounts(extra_bind_mounts, False)),
+          ('--bindmount_ro', _dedup_mounts(readonly_bind_mounts, True)),
+          ('--env', env))
+      for value in values
+      for arg in (flag, value))
 
   nsjail_command.extend(extra_nsjail_args)
 
   nsjail_command.append('--')
   nsjail_command.extend(command)
 
+  if sum(len(arg) + 1 for arg in nsjail_command) > _MAX_COMMAND_LENGTH:
+    nsjail_command = _dump_mounts_to_config(nsjail_command, config_file)
+
   return nsjail_command
 
 def run_command(nsjail_command,
                 mount_local_device=False,
                 dry_run=False,
                 quiet=False,
+                use_exec=False,
                 stdout=None,
                 stderr=None):
   """Run the provided nsjail command.
@@ -362,6 +490,8 @@ def run_command(nsjail_command,
     dry_run: If true, the command will be returned but not executed
     quiet: If true, the function will not display the command and
       will pass -quiet argument to nsjail
+    use_exec: If true, replace the current process with nsjail instead of
+      running it as a child process. The function never returns in that case.
     stdout: the standard output for all printed messages. Valid values are None, a file
       descriptor or file object. A None value means sys.stdout is used.
     stderr: the standard error for all printed messages. Valid values are None, a file
@@ -371,28 +501,46 @@ def run_command(nsjail_command,
 
   if mount_local_device:
     # A device can only communicate with one adb server at a time, so the adb server is
-    # killed on the host machine.
-    for line in subprocess.check_output(['ps','-eo','cmd']).decode().split('\n'):
-      if re.match(r'adb.*fork-server.*', line):
+    # killed on the host machine. Scan /proc/*/cmdline directly rather than
+    # forking a `ps` process and parsing its output.
+    for pid in os.listdir('/proc'):
+      if not pid.isdigit():
+        continue
+      try:
+        with open(os.path.join('/proc', pid, 'cmdline'), 'rb') as cmdline_file:
+          cmdline = cmdline_file.read().replace(b'\0', b' ').decode(errors='replace')
+      except OSError:
+        # The process exited while scanning.
+        continue
+      if _ADB_FORKSERVER_RE.search(cmdline):
         print('An adb server is running on your host machine. This server must be '
               'killed to use the --mount_local_device flag.')
         print('Continue? [y/N]: ', end='')
         if input().lower() != 'y':
           exit()
         subprocess.check_call(['adb', 'kill-server'])
+        # One kill-server covers every fork-server, so stop scanning.
+        break
 
   if not quiet:
     print('NsJail command:', file=stdout)
-    print(' '.join(nsjail_command), file=stdout)
+    print(shlex.join(nsjail_command), file=stdout)
 
   if not dry_run:
+    if use_exec and stdout is None and stderr is None:
+      # nsjail hosts the entire build, so there is no reason to keep this
+      # Python process resident for its multi-hour duration just to wait.
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os.execvp(nsjail_command[0], nsjail_command)
     subprocess.check_call(nsjail_command, stdout=stdout, stderr=stderr)
 
-def parse_args():
-  """Parse command line arguments.
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+  """Build the command line argument parser once per process.
 
   Returns:
-    An argparse.Namespace object.
+    An argparse.ArgumentParser object.
   """
 
   # Use the top level module docstring for the help description
@@ -495,6 +643,12 @@ def parse_args():
       'the container. WARNING: Using this flag will cause the adb server to be '
       'killed on the host machine. WARNING: Using this flag exposes parts of '
       'the host /sys/... file system. Use only when you need adb.')
+  parser.add_argument(
+      '--use_exec',
+      action='store_true',
+      help='Replace the current process with nsjail rather than running '
+      'nsjail as a child process. This saves one resident process for the '
+      'duration of the build.')
   parser.add_argument(
       '--env', '-e',
       type=str,
@@ -502,7 +656,15 @@ def parse_args():
       action='append',
       help='Specify an environment variable to the NSJail sandbox. Can be specified '
       'muliple times. Syntax: var_name=value')
-  return parser.parse_args()
+  return parser
+
+def parse_args():
+  """Parse command line arguments.
+
+  Returns:
+    An argparse.Namespace object.
+  """
+  return _build_parser().parse_args()
 
 def run_with_args(args):
   """Run inside an NsJail sandbox.
@@ -534,6 +696,7 @@ def run_with_args(args):
       readonly_bind_mounts=args.bindmount_ro,
       dry_run=args.dry_run,
       quiet=args.quiet,
+      use_exec=args.use_exec,
       env=args.env)
 
 def main():
@@ -147,6 +147,30 @@ class NsjailTest(unittest.TestCase):
         ]
     )
 
+  def testManyBindMountsUseConfigFile(self):
+    with tempfile.TemporaryDirectory() as temp_dir:
+      with open(os.path.join(temp_dir, 'nsjail.cfg'), 'w') as config:
+        config.write('name: "test-sandbox"\n')
+      nsjail.__file__ = os.path.join(temp_dir, 'nsjail.py')
+      mounts = ['/mount/src%d:/mount/dest%d' % (i, i) for i in range(10000)]
+      commands = nsjail.run(
+          nsjail_bin='/bin/true',
+          chroot='/chroot',
+          source_dir='/source_dir',
+          command=['/bin/bash'],
+          android_target='target_name',
+          extra_bind_mounts=mounts,
+          quiet=True,
+          dry_run=True)
+      self.assertNotIn('--bindmount', commands)
+      generated_config = commands[commands.index('--config') + 1]
+      with open(generated_config) as config:
+        config_contents = config.read()
+      self.assertIn('name: "test-sandbox"', config_contents)
+      self.assertIn('src: "/source_dir"\n  dst: "/src"', config_contents)
+      self.assertIn('src: "/mount/src9999"\n  dst: "/mount/dest9999"',
+                    config_contents)
+
   def testEnv(self):
     commands = nsjail.run(
         nsjail_bin='/bin/true',
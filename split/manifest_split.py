@@ -59,6 +59,7 @@ options:
 
 from __future__ import print_function
 
+import functools
 import getopt
 import hashlib
 import json
@@ -144,8 +145,9 @@ def get_module_info(module_info_file, repo_projects):
         for module in module_info
         if module_has_valid_path(module)
     }
+    repo_trie = build_repo_trie(repo_projects)
     module_project_paths = {
-        module: scan_repo_projects(repo_projects, module_paths[module])
+        module: scan_repo_trie(repo_trie, module_paths[module])
         for module in module_paths
     }
 
@@ -256,25 +258,62 @@ def get_kati_makefiles(kati_stamp_file, overlays):
   return makefiles_and_symlinks
 
 
-def scan_repo_projects(repo_projects, input_path):
-  """Returns the project path of the given input path if it exists.
+def build_repo_trie(repo_projects):
+  """Builds a trie of path components over the repo project paths.
 
   Args:
     repo_projects: The output of the get_repo_projects function.
+
+  Returns:
+    A nested dict keyed by path component. Nodes that terminate a project
+    path store the full project path under the "$" key.
+  """
+  trie = {}
+  for project_path in repo_projects:
+    node = trie
+    for part in project_path.split("/"):
+      node = node.setdefault(part, {})
+    node["$"] = project_path
+  return trie
+
+
+def scan_repo_trie(repo_trie, input_path):
+  """Returns the longest project path containing input_path, if it exists.
+
+  Args:
+    repo_trie: The output of the build_repo_trie function.
     input_path: The path of an input file used in the build, as given by the
       ninja inputs tool.
 
   Returns:
     The path string, or None if not found.
   """
-  parts = input_path.split("/")
+  project_path = None
+  node = repo_trie
+  for part in input_path.split("/"):
+    node = node.get(part)
+    if node is None:
+      break
+    if "$" in node:
+      project_path = node["$"]
+  return project_path
 
-  for index in reversed(range(0, len(parts))):
-    project_path = os.path.join(*parts[:index + 1])
-    if project_path in repo_projects:
-      return project_path
 
-  return None
+def scan_repo_projects(repo_projects, input_path):
+  """Returns the project path of the given input path if it exists.
+
+  Callers resolving many paths against the same projects should build the
+  trie once with build_repo_trie and use scan_repo_trie directly.
+
+  Args:
+    repo_projects: The output of the get_repo_projects function.
+    input_path: The path of an input file used in the build, as given by the
+      ninja inputs tool.
+
+  Returns:
+    The path string, or None if not found.
+  """
+  return scan_repo_trie(build_repo_trie(repo_projects), input_path)
 
 
 def get_input_projects(repo_projects, inputs):
@@ -285,8 +324,21 @@ def get_input_projects(repo_projects, inputs):
     inputs: The paths of input files used in the build, as given by the ninja
       inputs tool.
   """
+  repo_trie = build_repo_trie(repo_projects)
+
+  # Many inputs share a directory, so memoize the resolution per directory
+  # rather than rescanning the repo projects for every file.
+  @functools.lru_cache(maxsize=None)
+  def scan_repo_dir(dirname):
+    return scan_repo_trie(repo_trie, dirname)
+
+  def scan_path(input_path):
+    if input_path in repo_projects:
+      return input_path
+    return scan_repo_dir(os.path.dirname(input_path))
+
   input_project_paths = [
-      scan_repo_projects(repo_projects, input_path)
+      scan_path(input_path)
       for input_path in inputs
       if (not input_path.startswith("out/") and not input_path.startswith("/"))
   ]
@@ -311,12 +363,25 @@ def update_manifest(manifest, input_projects, remove_projects):
   """
   projects_to_keep = input_projects.difference(remove_projects)
   root = manifest.getroot()
-  for child in root.findall("project"):
-    if child.attrib["name"] not in projects_to_keep:
-      root.remove(child)
+  # Filter in a single pass; findall plus one root.remove per dropped
+  # project is quadratic on manifests with thousands of projects.
+  root[:] = [
+      child for child in root
+      if child.tag != "project" or child.attrib["name"] in projects_to_keep
+  ]
   return manifest
 
 
+class HashingWriter(object):
+  """A write-only file object that feeds written data into a hash object."""
+
+  def __init__(self, hasher):
+    self._hasher = hasher
+
+  def write(self, data):
+    self._hasher.update(data)
+
+
 def create_manifest_sha1_element(manifest, name):
   """Creates and returns an ElementTree 'hash' Element using a sha1 hash.
 
@@ -330,8 +395,11 @@ def create_manifest_sha1_element(manifest, name):
   sha1_element = ET.Element("hash")
   sha1_element.set("type", "sha1")
   sha1_element.set("name", name)
-  sha1_element.set("value",
-                   hashlib.sha1(ET.tostring(manifest.getroot())).hexdigest())
+  # Serialize straight into the hash rather than materializing the whole
+  # manifest as one bytes object first.
+  hasher = hashlib.sha1()
+  manifest.write(HashingWriter(hasher))
+  sha1_element.set("value", hasher.hexdigest())
   return sha1_element
 
 